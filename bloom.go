@@ -0,0 +1,50 @@
+package dedup
+
+import (
+	"hash/maphash"
+)
+
+// bloomFilter is a probabilistic set. It can report that a line has possibly been added before,
+// when it actually hasn't (a false positive), but never that a line hasn't been added when it has.
+// It uses a fixed number of bits no matter how many lines are added to it.
+type bloomFilter struct {
+	bits   []uint64
+	size   uint64
+	hashes int
+	hash   maphash.Hash
+}
+
+// newBloomFilter creates a bloom filter of size bits, which sets hashes bits for each line
+func newBloomFilter(size uint64, hashes int) *bloomFilter {
+	if hashes < 1 {
+		hashes = 1
+	}
+	bf := &bloomFilter{
+		bits:   make([]uint64, (size+63)/64),
+		size:   size,
+		hashes: hashes,
+	}
+	bf.hash.SetSeed(maphash.MakeSeed())
+	return bf
+}
+
+// testAndAdd adds the line to the filter, and returns true if the line was possibly added before
+func (bf *bloomFilter) testAndAdd(line []byte) bool {
+	bf.hash.Reset()
+	bf.hash.Write(line)
+	sum := bf.hash.Sum64()
+
+	// Derive all the bit positions from a single hash (Kirsch-Mitzenmacher double hashing)
+	h1 := sum
+	h2 := sum>>32 | 1
+	seen := true
+	for i := 0; i < bf.hashes; i++ {
+		bit := (h1 + uint64(i)*h2) % bf.size
+		word, mask := bit/64, uint64(1)<<(bit%64)
+		if bf.bits[word]&mask == 0 {
+			seen = false
+			bf.bits[word] |= mask
+		}
+	}
+	return seen
+}
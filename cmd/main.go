@@ -37,8 +37,11 @@ func main() {
 	flag.Var(&skipPatterns, "skip-pattern", "re2 regex pattern that will skip the line if it matches (flag can be used multiple times)")
 	outFileLoc := flag.String("out", "", "output file location")
 	tmpFileBytes := flag.Uint64("tmp-file-bytes", 250000000,
-		"max temporary file byte size. app will use 2-5x more memory than this to run")
+		"max bytes of memory for holding distinct lines before they are spilled to a temporary file. app will use up to 2x more memory than this to run")
 	appendFlag := flag.Bool("append", false, "should append to file (default: only allow new files)")
+	bloomBits := flag.Uint64("bloom-bits", 0,
+		"bits in a bloom filter that lets lines not seen before skip the in-memory set (default: no bloom filter)")
+	bloomHashes := flag.Int("bloom-hashes", 4, "number of hashes per line in the bloom filter")
 	flag.Parse()
 
 	if inFileGlobs == nil || len(inFileGlobs) == 0 {
@@ -50,6 +53,9 @@ func main() {
 	if tmpFileBytes == nil || *tmpFileBytes <= 0 {
 		log.Fatal("tmp-file-bytes flag must be a positive integer or omitted for the default")
 	}
+	if bloomHashes == nil || *bloomHashes <= 0 {
+		log.Fatal("bloom-hashes flag must be a positive integer or omitted for the default")
+	}
 
 	// Compile regexp's
 	var skipPatternsCompiled []*regexp.Regexp
@@ -109,7 +115,7 @@ func main() {
 
 	// Dedup
 	log.Println("Starting dedup...")
-	err = dedup.Dedup(outFile, *tmpFileBytes, skipPatternsCompiled, inReader, progressReader)
+	err = dedup.DedupWithBloomFilter(outFile, *tmpFileBytes, *bloomBits, *bloomHashes, skipPatternsCompiled, inReader, progressReader)
 	if err != nil {
 		log.Fatal(err)
 	}
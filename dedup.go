@@ -18,14 +18,55 @@ import (
 	"os"
 	"regexp"
 	"sort"
+	"sync"
 	"sync/atomic"
 	"time"
 )
 
 const defaultBufferSize int = 256 * 1024 // 256 kb
 
+const readBufferSize int = 1024 * 1024 // 1 mb
+
+const writeBufferSize int = 4 * 1024 * 1024 // 4 mb
+
+// releaseMappedBytes is how much of a memory mapped chunk is merged before its consumed pages are
+// released with MADV_DONTNEED, the mapping counterpart of POSIX_FADV_DONTNEED, so that chunks that are
+// only partly merged don't keep counting towards this program's memory usage.
+const releaseMappedBytes int = 1024 * 1024 // 1 mb
+
+// maxMergeFanIn is the most chunks that are merged at once. Merging fewer at a time keeps the heap
+// and the pages being read from each chunk small enough to stay in the CPU caches, and the number
+// of open files well below the usual limits, at the cost of another pass over the data for every
+// 64 times more chunks.
+const maxMergeFanIn int = 64
+
+// maxUnindexedDuplicates is one over the fraction of duplicate lines a set can catch,
+// below which the following sets are no longer indexed
+const maxUnindexedDuplicates int = 100
+
 var delimiter byte = "\n"[0]
 
+// writerPool holds buffered writers, so that their large buffers are reused by every chunk and merge
+// instead of being allocated again for each file
+var writerPool = sync.Pool{
+	New: func() interface{} {
+		return bufio.NewWriterSize(nil, writeBufferSize)
+	},
+}
+
+// getWriter returns a buffered writer from the pool that writes to w
+func getWriter(w io.Writer) *bufio.Writer {
+	writer := writerPool.Get().(*bufio.Writer)
+	writer.Reset(w)
+	return writer
+}
+
+// putWriter returns a buffered writer to the pool. Anything still buffered is discarded.
+func putWriter(writer *bufio.Writer) {
+	writer.Reset(nil)
+	writerPool.Put(writer)
+}
+
 //
 // Implementation Design:
 // When the deduplicated content is larger in bytes than our machine's memory, we will not be able
@@ -38,6 +79,8 @@ var delimiter byte = "\n"[0]
 // first lexicographically will be written to the output (merged) file. We are guaranteed that
 // by doing so, the merge algorithm will see any duplicates between the files in sequence, and we
 // deduplicate by skipping all but the first.
+// The chunks are kept in a min-heap ordered by their current line, so choosing the next line takes
+// O(log k) comparisons for k chunks, and a chunk that runs out of lines is simply dropped from the heap.
 // The resulting output (merged) file is then fully deduplicated, and it is also sorted as a
 // side effect of choosing this implementation.
 // A second side benefit of this implementation is that this program can be run against an input
@@ -52,6 +95,17 @@ var delimiter byte = "\n"[0]
 // into a set, and writing out the set to a temporary file each time the set approaches tmpFileBytes
 // in size. It will then merge the temporary files while deduplicating the lines, into the final file.
 func Dedup(outFile *os.File, tmpFileBytes uint64, skipPatterns []*regexp.Regexp, inFile, inFileAgain io.Reader) error {
+	return DedupWithBloomFilter(outFile, tmpFileBytes, 0, 0, skipPatterns, inFile, inFileAgain)
+}
+
+// DedupWithBloomFilter is the same as Dedup, except that when bloomBits is greater than zero,
+// every line is first checked against a bloom filter of that many bits, using bloomHashes hashes.
+// Lines the filter has definitely not seen before skip the set, and are written straight to a
+// temporary passthrough file, so only lines that might be duplicates are held in memory.
+// This suits inputs where most lines are unique. If the possible duplicates fit into tmpFileBytes,
+// the output is the passthrough file followed by the sorted possible duplicates that were not
+// in it, so the output is not sorted. Otherwise the passthrough file is sorted and merged as usual.
+func DedupWithBloomFilter(outFile *os.File, tmpFileBytes, bloomBits uint64, bloomHashes int, skipPatterns []*regexp.Regexp, inFile, inFileAgain io.Reader) error {
 	// Allow cancellation of progress tracker
 	ctx, cancel := context.WithCancel(context.Background())
 	defer cancel()
@@ -82,33 +136,90 @@ func Dedup(outFile *os.File, tmpFileBytes uint64, skipPatterns []*regexp.Regexp,
 		}()
 	}
 
+	// Create the bloom filter and the passthrough file for lines it has definitely not seen before
+	var (
+		bloom             *bloomFilter
+		passthrough       *os.File
+		passthroughWriter *bufio.Writer
+		err               error
+	)
+	if bloomBits > 0 {
+		bloom = newBloomFilter(bloomBits, bloomHashes)
+		passthrough, err = os.CreateTemp("", "dedup.*.log")
+		if err != nil {
+			return err
+		}
+		defer func() {
+			passthrough.Close()
+			os.Remove(passthrough.Name())
+		}()
+		fmt.Println("Creating temporary file:", passthrough.Name())
+		passthroughWriter = bufio.NewWriterSize(passthrough, writeBufferSize)
+	}
+
 	// Write out chunks
-	chunks, err := splitSortDeduplicate(outFile, tmpFileBytes, skipPatterns, &progress, inFile)
+	chunks, sets, err := splitSortDeduplicate(tmpFileBytes, skipPatterns, bloom, passthroughWriter, &progress, inFile)
 
 	// No matter how or when we exit, cleanup all temporary files
-	defer func(chunks []*os.File) {
+	defer func() {
 		for _, chunk := range chunks {
-			// Only cleanup files this package created, do not cleanup the outfile (we didn't create it)
-			if chunk != outFile {
-				chunk.Close()
-				os.Remove(chunk.Name())
-			}
+			os.Remove(chunk.name)
 		}
-	}(chunks)
+	}()
 
 	// Handle error from splitSortDeduplicate
 	if err != nil {
 		return err
 	}
 
-	// No need to merge anything if the input file was empty,
-	// or we were able to fit it in memory and wrote everything directly to the output file already
-	if len(chunks) <= 1 {
-		return nil
+	if bloom != nil {
+		err = passthroughWriter.Flush()
+		if err != nil {
+			return err
+		}
+
+		// If all the possible duplicates fit into memory, we can write the passthrough file to the output file,
+		// followed by the possible duplicates that were not in it, without having to sort the passthrough file
+		if len(chunks) == 0 && len(sets) == 1 {
+			fmt.Println("Writing to file:", outFile.Name())
+			return writeBloomOutput(outFile, passthrough, sets[0], &progress)
+		}
+
+		// Otherwise the passthrough file has to be split into sorted chunks too, and merged along with the others
+		for _, set := range sets {
+			if set.len() > 0 {
+				chunk, err := writeChunk(set, &progress)
+				if err != nil {
+					return err
+				}
+				chunks = append(chunks, chunk)
+			}
+		}
+
+		_, err = passthrough.Seek(0, 0)
+		if err != nil {
+			return err
+		}
+		var passthroughProgress uint64 // These lines have already been counted
+		var passthroughChunks []*chunk
+		passthroughChunks, sets, err = splitSortDeduplicate(tmpFileBytes, nil, nil, nil, &passthroughProgress, passthrough)
+		chunks = append(chunks, passthroughChunks...)
+		if err != nil {
+			return err
+		}
 	}
 
+	// If no temporary files have been created, it means all the deduplicated strings fit into
+	// memory, and we can write directly to the output file without having to make temporary chunks
+	if len(chunks) == 0 && len(sets) == 1 {
+		fmt.Println("Writing to file:", outFile.Name())
+		return writeLines(outFile, sets[0], sortSet(sets[0], &progress), &progress)
+	}
+
+	// Otherwise the sets still in memory are merged along with any temporary files,
+	// rather than being written to more temporary files and read back in
 	fmt.Println("Merging temporary files into:", outFile.Name())
-	return mergeChunks(outFile, &progress, chunks)
+	return mergeChunks(outFile, &progress, chunks, sets)
 }
 
 // countLines returns the number of lines in a file
@@ -148,161 +259,273 @@ func countLines(r io.Reader) (uint64, error) {
 }
 
 // splitSortDeduplicate reads in the input file, and deduplicates the lines as it reads them in.
-// If the total size of the deduplicated lines exceeds tmpFileBytes, it will begin writing out
-// the sets as sorted chunks to temporary files. If the size doesn't exceed tmpFileBytes,
-// it will write the full sorted deduplicated set to the output file.
-// It returns all files it wrote to.
-func splitSortDeduplicate(outFile *os.File, tmpFileBytes uint64, skipPatterns []*regexp.Regexp, progress *uint64, inFile io.Reader) ([]*os.File, error) {
-	// Create a scanner to buffer the input file and read in line tokens
-	scanner := bufio.NewScanner(inFile)
+// If the memory used by the set of deduplicated lines would exceed tmpFileBytes, it will begin
+// writing out the sets as sorted chunks to temporary files.
+// If bloom is not nil, lines it has definitely not seen before are written to passthrough instead
+// of being added to the set.
+// It returns all temporary files it wrote to, and the sets of deduplicated lines still in memory,
+// which always includes the last set (even if it is empty).
+func splitSortDeduplicate(tmpFileBytes uint64, skipPatterns []*regexp.Regexp, bloom *bloomFilter, passthrough *bufio.Writer, progress *uint64, inFile io.Reader) ([]*chunk, []*lineSet, error) {
+	// Read the input file in large blocks, splitting the lines out of each block in place
+	lines := newLineReader(inFile, readBufferSize)
 
-	// Set scanner's buffer size to be a bit larger
-	scanner.Buffer(make([]byte, 0, defaultBufferSize), bufio.MaxScanTokenSize)
-
-	// Create a hash set (map with empty values) with decent initial size
-	set := make(map[string]struct{}, 1024)
+	// Create a set of distinct lines with decent initial size
+	set := newLineSet(0, true)
 
 	// Create counters and a slice of temporary files being created
 	var (
-		chunks      []*os.File
-		bytesUsed   uint64
-		previousLen int
-		currentLen  int
-		lineCount   uint64
+		chunks     []*chunk
+		lineCount  uint64
+		duplicates int
+		indexed    = true
 	)
 
-	// Advance the scanner to the next token
-	hasNext := scanner.Scan()
-	if !hasNext {
-		return nil, scanner.Err()
+	// The first set to be spilled is kept in memory instead of being written out, in case the rest of
+	// the input fits into just one more set, which happens whenever the input only just doesn't fit.
+	// Both sets can then be merged straight from memory, without any temporary files at all.
+	// Otherwise it is written out at the next spill, before the next set is written in the background,
+	// so that there are never more than two full sets in memory.
+	var retained *lineSet
+	inMemory := func() []*lineSet {
+		if retained != nil {
+			return []*lineSet{retained, set}
+		}
+		return []*lineSet{set}
+	}
+
+	// Chunks are sorted and written in the background, one at a time, so that reading and
+	// deduplicating the input carries on while the previous chunk is written to disk.
+	// Always wait for the background write to finish before returning.
+	var pending chan chunkWrite
+	waitPending := func() (chunkWrite, error) {
+		if pending == nil {
+			return chunkWrite{}, nil
+		}
+		written := <-pending
+		pending = nil
+		return written, written.err
 	}
+	defer waitPending()
 
 	// Loop until the file is finished
 loop:
 	for {
-		// Read the token in and add to the set
-		line := scanner.Text()
-		hasNext = scanner.Scan() // Peak ahead
+		line, ok := lines.next()
+		if !ok {
+			break loop
+		}
 		lineCount++
 
 		// Skip lines
 		for _, pattern := range skipPatterns {
-			if pattern.MatchString(line) {
+			if pattern.Match(line) {
 				lineCount++ // One more line that doesn't have to be written
 				continue loop
 			}
 		}
 
-		// This is what is written, to chunks or to the output file directly
-		set[line] = struct{}{}
-
-		// The length of a map is stored in the map (in golang), so the operation is nearly free
-		currentLen = len(set)
-
-		// Peek ahead to see if there are more tokens, or exit loop if the file is finished
-		if !hasNext {
-			if currentLen == previousLen {
-				lineCount++ // One more line that doesn't have to be written
+		// Lines the bloom filter has definitely not seen before can't be duplicates, so don't need to be in the set
+		if bloom != nil && !bloom.testAndAdd(line) {
+			_, err := passthrough.Write(line)
+			if err != nil {
+				return chunks, inMemory(), err
 			}
-			atomic.AddUint64(progress, lineCount)
-			break loop
-		}
-		if lineCount >= 1000 {
-			atomic.AddUint64(progress, lineCount)
-			lineCount = 0
+			err = passthrough.WriteByte(delimiter)
+			if err != nil {
+				return chunks, inMemory(), err
+			}
+			continue loop
 		}
 
-		// If the length of the set increased, add the byte length of the string to the memory counter,
-		// plus one for a new line
-		if currentLen > previousLen {
-			bytesUsed += uint64(len(line)) + 1
-
-			// If the total bytes of all distinct strings in the set, plus the upcoming line,
-			// are equal or greater than what we want, then spill to a new temp file
-			if bytesUsed+uint64(len(scanner.Bytes()))+1 > tmpFileBytes {
-				// Create a new temporary file
-				chunkFile, err := os.CreateTemp("", "dedup.*.log")
+		// If the memory used by the set, including all distinct strings, their new lines and the index of them,
+		// would be greater than what we want after adding this line, then spill the set to a new temp file first
+		if set.len() > 0 && (uint64(set.memoryToAdd(len(line))) > tmpFileBytes || set.full()) && set.find(line) < 0 {
+			var written chunkWrite
+			if len(chunks) == 0 && retained == nil {
+				retained = set
+			} else {
+				// Only one chunk is written at a time, so wait for the previous one
+				var err error
+				written, err = waitPending()
 				if err != nil {
-					return chunks, err
+					return chunks, inMemory(), err
 				}
-				chunks = append(chunks, chunkFile)
-				fmt.Println("Creating temporary file:", chunkFile.Name())
 
-				// Sort and write to file
-				err = writeSlice(chunkFile, sortKeys(set), nil)
+				if retained != nil {
+					c, err := writeChunk(retained, progress)
+					if err != nil {
+						return chunks, inMemory(), err
+					}
+					chunks = append(chunks, c)
+					retained = nil
+				}
+
+				chunkFile, err := createChunk()
 				if err != nil {
-					return chunks, err
+					return chunks, inMemory(), err
 				}
+				c := &chunk{name: chunkFile.Name()}
+				chunks = append(chunks, c)
 
-				// Overwrite the set so the old one can be GC'ed, reset counters
-				set = make(map[string]struct{}, 1024)
-				bytesUsed = 0
-				currentLen = 0
+				// Sort and write to file in the background
+				pending = make(chan chunkWrite, 1)
+				go func(set *lineSet, c *chunk, chunkFile *os.File, done chan<- chunkWrite) {
+					duplicates, err := writeSortedChunk(c, chunkFile, set, progress)
+					done <- chunkWrite{lines: set.len(), duplicates: duplicates, indexed: set.indexed, err: err}
+				}(set, c, chunkFile, pending)
 			}
-		} else {
+
+			// The next chunk will likely hold as many lines as this one, so size the new set to fit
+			// them up front, rather than rebuilding its table each time the set has to grow.
+			// An unindexed set also holds its duplicates, so an indexed set following it is sized for
+			// the distinct lines of the last unindexed set to finish, if that is known.
+			lines := set.len()
+
+			// If the set hardly caught any duplicates, indexing the lines isn't worth its time and memory,
+			// so lines are only appended to the next set, and duplicates are dropped once it is sorted.
+			// The duplicates in an unindexed set are only known once it has been sorted in the background,
+			// so the decision is made again from the last unindexed set to finish, and indexing is turned
+			// back on as soon as the input starts repeating itself.
+			// Sets with too few lines to have caught a single duplicate in maxUnindexedDuplicates don't
+			// change the decision.
+			if set.indexed {
+				if set.len() >= maxUnindexedDuplicates {
+					indexed = duplicates*maxUnindexedDuplicates >= set.len()
+				}
+			} else {
+				if !written.indexed && written.lines >= maxUnindexedDuplicates {
+					indexed = written.duplicates*maxUnindexedDuplicates >= written.lines
+				}
+				if indexed {
+					lines = 0
+					if !written.indexed {
+						lines = written.lines - written.duplicates
+					}
+				}
+			}
+			duplicates = 0
+
+			// Replace the set so the old one can be GC'ed once written.
+			set = newLineSet(lines, indexed)
+		}
+
+		// This is what is written, to chunks or to the output file directly
+		if !set.add(line) {
 			lineCount++ // One more line that doesn't have to be written
+			duplicates++
+		}
+
+		if lineCount >= 1000 {
+			atomic.AddUint64(progress, lineCount)
+			lineCount = 0
 		}
-		previousLen = currentLen
 	}
-	err := scanner.Err()
+	atomic.AddUint64(progress, lineCount)
+
+	_, err := waitPending()
 	if err != nil {
-		return chunks, err
+		return chunks, inMemory(), err
 	}
+	return chunks, inMemory(), lines.Err()
+}
 
-	// There is at least one string left in the set.
-	// If no temporary files have been created, it means all the deduplicated strings fit into
-	// memory, and we can write directly to the output file without having to make temporary chunks
-	finalChunk := outFile
-	finalProgress := progress
-	if len(chunks) > 0 {
-		// If we have already made other temporary files, then we have to make another
-		finalChunk, err = os.CreateTemp("", "dedup.*.log")
-		if err != nil {
-			return chunks, err
-		}
-		finalProgress = nil
-		fmt.Println("Creating temporary file:", finalChunk.Name())
-	} else {
-		fmt.Println("Writing to file:", finalChunk.Name())
-	}
-	chunks = append(chunks, finalChunk)
+// chunk is a temporary file of sorted distinct lines, waiting to be merged.
+// Its last line and line count are kept from when it was written, so that it can be copied to the
+// output without reading it, when its lines don't overlap with any other chunk.
+type chunk struct {
+	name  string
+	last  []byte
+	lines uint64
+}
 
-	// Write any remaining distinct strings
-	return chunks, writeSlice(finalChunk, sortKeys(set), finalProgress)
+// createChunk creates a new temporary file for a chunk
+func createChunk() (*os.File, error) {
+	chunkFile, err := os.CreateTemp("", "dedup.*.log")
+	if err != nil {
+		return nil, err
+	}
+	fmt.Println("Creating temporary file:", chunkFile.Name())
+	return chunkFile, nil
 }
 
-// sortKeys takes a map and puts the keys into a sorted slice
-func sortKeys(set map[string]struct{}) []string {
-	slice := make([]string, len(set))
-	i := 0
-	for k := range set {
-		slice[i] = k
-		i++
+// writeChunk creates a new temporary file, and writes the set to it sorted
+func writeChunk(set *lineSet, progress *uint64) (*chunk, error) {
+	chunkFile, err := createChunk()
+	if err != nil {
+		return nil, err
 	}
 
-	// Sort in place
-	sort.Strings(slice)
-	return slice
+	c := &chunk{name: chunkFile.Name()}
+	_, err = writeSortedChunk(c, chunkFile, set, progress)
+	if err != nil {
+		os.Remove(c.name)
+		return nil, err
+	}
+	return c, nil
 }
 
-// writeSlice writes all strings in the slice to the file, delimited by a new line
-func writeSlice(f *os.File, slice []string, progress *uint64) error {
-	// Buffer the writes
-	writer := bufio.NewWriterSize(f, defaultBufferSize)
-	var line string
-	var err error
+// writeSortedChunk sorts the set and writes it to the chunk file, then closes the file, so that
+// chunks don't hold on to a file descriptor each until they are merged. The chunk's last line
+// and line count are set from the set.
+// The file is preallocated to its final size first, so that the filesystem does not have to
+// allocate and fragment it one write at a time.
+// It returns how many duplicates were dropped from an unindexed set, which are also added to the
+// progress if it is not nil.
+func writeSortedChunk(c *chunk, chunkFile *os.File, set *lineSet, progress *uint64) (int, error) {
+	order := sortSet(set, progress)
+	c.lines = uint64(len(order))
+	if len(order) > 0 {
+		// Copy the line, because the set is released once it has been written
+		c.last = append([]byte(nil), set.line(order[len(order)-1])...)
+	}
 
-	// Write to temporary file
-	var lineCount uint64
-	for _, line = range slice {
-		// Write line
-		_, err = writer.WriteString(line)
-		if err != nil {
-			return err
+	size := int64(set.bytes())
+	if len(order) < set.len() {
+		// Duplicates have been dropped, so not all of the bytes will be written
+		size = 0
+		for _, i := range order {
+			size += int64(len(set.lineWithDelimiter(i)))
 		}
+	}
+	_ = preallocateFile(chunkFile, size) // Only an optimization, so the error can be ignored
 
-		// Write delimiter
-		err = writer.WriteByte(delimiter)
+	err := writeLines(chunkFile, set, order, nil)
+	closeErr := chunkFile.Close()
+	if err == nil {
+		err = closeErr
+	}
+	return set.len() - len(order), err
+}
+
+// chunkWrite is the result of sorting and writing a set to a chunk in the background
+type chunkWrite struct {
+	lines      int  // Lines in the set
+	duplicates int  // Duplicate lines dropped while sorting the set
+	indexed    bool // Whether the set was indexed, in which case it could not have had any duplicates
+	err        error
+}
+
+// sortSet returns the sorted positions of the set's lines. Duplicates in an unindexed set are only
+// dropped here, so they are added to the progress now, as lines that don't have to be written.
+func sortSet(set *lineSet, progress *uint64) []uint32 {
+	order := set.sorted()
+	if progress != nil {
+		atomic.AddUint64(progress, uint64(set.len()-len(order)))
+	}
+	return order
+}
+
+// writeLines writes the lines of the set at the given positions to the file, delimited by a new line
+func writeLines(f *os.File, set *lineSet, order []uint32, progress *uint64) error {
+	// Buffer the writes, so that lines are written to the file in large blocks
+	writer := getWriter(f)
+	defer putWriter(writer)
+
+	// Write to file
+	var lineCount uint64
+	for _, i := range order {
+		// Write line and delimiter
+		_, err := writer.Write(set.lineWithDelimiter(i))
 		if err != nil {
 			return err
 		}
@@ -321,29 +544,171 @@ func writeSlice(f *os.File, slice []string, progress *uint64) error {
 	return writer.Flush()
 }
 
-// mergeChunks merges and deduplicates the chunk files into the output file
-func mergeChunks(outFile *os.File, progress *uint64, chunks []*os.File) error {
-	// Create a slice of buffered scanners for each chunk
-	scanners := make([]*sortableScanner, 0, len(chunks))
+// writeBloomOutput writes every line of the passthrough file to the output file, followed by
+// the sorted lines of the set that were not in the passthrough file.
+// The passthrough file has no duplicates, because the bloom filter sees any repeat of its lines.
+func writeBloomOutput(outFile *os.File, passthrough *os.File, set *lineSet, progress *uint64) error {
+	_, err := passthrough.Seek(0, 0)
+	if err != nil {
+		return err
+	}
+	lines := newLineReader(passthrough, readBufferSize)
 
-	// Add sorted scanners to the slice
-	for _, chunk := range chunks {
-		ss := &sortableScanner{
-			scanner: bufio.NewScanner(chunk), // Use default buffer size since there are many chunks
-			f:       chunk,
+	// Buffer the writes, so that lines are written to the file in large blocks
+	writer := getWriter(outFile)
+	defer putWriter(writer)
+
+	// Remember which possible duplicates turn out to be in the passthrough file
+	written := make([]bool, set.len())
+
+	var lineCount uint64
+	for {
+		line, ok := lines.next()
+		if !ok {
+			break
+		}
+
+		if i := set.find(line); i >= 0 {
+			written[i] = true
 		}
-		scanners = append(scanners, ss)
 
-		// Seek to the beginning of the file to start reading again from the start
-		_, err := ss.f.Seek(0, 0)
+		_, err = writer.Write(line)
+		if err != nil {
+			return err
+		}
+		err = writer.WriteByte(delimiter)
 		if err != nil {
 			return err
 		}
 
+		lineCount++
+		if lineCount >= 1000 {
+			atomic.AddUint64(progress, lineCount)
+			lineCount = 0
+		}
+	}
+	atomic.AddUint64(progress, lineCount)
+
+	err = lines.Err()
+	if err != nil {
+		return err
+	}
+	err = writer.Flush()
+	if err != nil {
+		return err
+	}
+
+	// Write the possible duplicates that were not in the passthrough file.
+	// The ones that were have already been written, so they are only added to the progress.
+	var order []uint32
+	for _, i := range set.sorted() {
+		if !written[i] {
+			order = append(order, i)
+		}
+	}
+	atomic.AddUint64(progress, uint64(set.len()-len(order)))
+	return writeLines(outFile, set, order, progress)
+}
+
+// mergeChunks merges and deduplicates the chunk files, along with the lines of the sets still
+// in memory, into the output file.
+// If there are more than maxMergeFanIn chunks and sets, the chunk files are first merged in groups
+// into larger temporary chunk files, repeating until few enough are left to merge them all at once.
+// Each chunk file is removed once all of its lines have been merged.
+func mergeChunks(outFile *os.File, progress *uint64, chunks []*chunk, sets []*lineSet) error {
+	// Cleanup the intermediate chunk files if we exit early
+	var intermediates []*chunk
+	defer func() {
+		for _, c := range intermediates {
+			os.Remove(c.name)
+		}
+	}()
+
+	for len(chunks)+len(sets) > maxMergeFanIn {
+		var merged []*chunk
+		for lo := 0; lo < len(chunks); lo += maxMergeFanIn {
+			group := chunks[lo:minInt(lo+maxMergeFanIn, len(chunks))]
+			if len(group) == 1 {
+				merged = append(merged, group[0])
+				continue
+			}
+
+			chunkFile, err := createChunk()
+			if err != nil {
+				return err
+			}
+			c := &chunk{name: chunkFile.Name()}
+			intermediates = append(intermediates, c)
+			merged = append(merged, c)
+
+			// The last line of the merged chunk is the greatest last line of the group
+			for _, g := range group {
+				if c.last == nil || bytes.Compare(g.last, c.last) > 0 {
+					c.last = g.last
+				}
+			}
+
+			// The lines of the merged chunk are counted again by the final merge,
+			// so only the duplicates dropped now count towards the progress
+			var groupProgress uint64
+			c.lines, err = mergeChunkGroup(chunkFile, &groupProgress, group, nil)
+			closeErr := chunkFile.Close()
+			if err == nil {
+				err = closeErr
+			}
+			if err != nil {
+				return err
+			}
+			atomic.AddUint64(progress, groupProgress-c.lines)
+		}
+		chunks = merged
+	}
+
+	_, err := mergeChunkGroup(outFile, progress, chunks, sets)
+	return err
+}
+
+// mergeChunkGroup merges and deduplicates the chunk files, along with the lines of the sets,
+// into the output file, all at once.
+// The chunk files are only opened here, so that no more than maxMergeFanIn are open at once,
+// and each is closed and removed once all of its lines have been merged.
+// It returns the number of lines written.
+func mergeChunkGroup(outFile *os.File, progress *uint64, chunks []*chunk, sets []*lineSet) (uint64, error) {
+	// Create a slice of scanners for each chunk and set
+	scanners := make([]*sortableScanner, 0, len(chunks)+len(sets))
+	for _, set := range sets {
+		if set.len() > 0 {
+			ss := newSetScanner(set, progress)
+			ss.next()
+			scanners = append(scanners, ss)
+		}
+	}
+
+	// Release and remove any chunks that were not fully merged
+	defer func() {
+		for _, ss := range scanners {
+			ss.close()
+		}
+	}()
+
+	// Add sorted scanners to the slice
+	for _, c := range chunks {
+		f, err := os.Open(c.name)
+		if err != nil {
+			return 0, err
+		}
+		ss, err := newSortableScanner(f)
+		if err != nil {
+			f.Close()
+			return 0, err
+		}
+		ss.last, ss.count = c.last, c.lines
+		scanners = append(scanners, ss)
+
 		// Scan the next token
 		ok, err := ss.next()
 		if err != nil {
-			return err
+			return 0, err
 		}
 
 		// Assert that there is content (every file guaranteed to have at least one line in it)
@@ -352,54 +717,114 @@ func mergeChunks(outFile *os.File, progress *uint64, chunks []*os.File) error {
 		}
 	}
 
-	return mergeSortableScanners(outFile, progress, scanners)
+	// Order the scanners by their first line, then split them into runs whose lines overlap.
+	// Runs do not share any lines, so they can be written one after the other, and only the scanners
+	// within a run need to be merged. A run of a single chunk file is copied directly to the output,
+	// which on Linux is done inside the kernel with copy_file_range.
+	sort.Slice(scanners, func(i, j int) bool {
+		return bytes.Compare(scanners[i].token, scanners[j].token) < 0
+	})
+	writer := getWriter(outFile)
+	defer putWriter(writer)
+	var written uint64
+	for lo := 0; lo < len(scanners); {
+		last := scanners[lo].last
+		hi := lo + 1
+		for ; hi < len(scanners) && bytes.Compare(scanners[hi].token, last) <= 0; hi++ {
+			if bytes.Compare(scanners[hi].last, last) > 0 {
+				last = scanners[hi].last
+			}
+		}
+
+		var (
+			lines uint64
+			err   error
+		)
+		if hi-lo == 1 && scanners[lo].f != nil {
+			lines, err = copyChunk(writer, outFile, progress, scanners[lo])
+		} else {
+			lines, err = mergeSortableScanners(writer, progress, scanners[lo:hi])
+		}
+		if err != nil {
+			return written, err
+		}
+		written += lines
+		lo = hi
+	}
+
+	// Flush all remaining bytes to the file
+	return written, writer.Flush()
+}
+
+// copyChunk copies the whole content of a chunk file to the output file, after flushing anything
+// still buffered in the writer, then releases and removes the chunk.
+// It returns the number of lines copied.
+func copyChunk(writer *bufio.Writer, outFile *os.File, progress *uint64, ss *sortableScanner) (uint64, error) {
+	err := writer.Flush()
+	if err != nil {
+		return 0, err
+	}
+
+	// Start from the beginning, as the first line has already been read
+	_, err = ss.f.Seek(0, 0)
+	if err != nil {
+		return 0, err
+	}
+	_, err = io.Copy(outFile, ss.f)
+	if err != nil {
+		return 0, err
+	}
+
+	atomic.AddUint64(progress, ss.count)
+	ss.close()
+	return ss.count, nil
 }
 
 // mergeSortableScanners reads a single token from each of the chunks, then chooses which one comes first
 // lexicographically, and writes that to a buffer. It then reads new token for that chunk, and
 // chooses again, repeating this process until all lines have been read from all chunks.
+// The scanners are kept in a min-heap ordered by their token, so choosing the next line only takes
+// O(log k) comparisons for k chunks, instead of re-sorting all the scanners for every line.
 // To deduplicate, it remembers the previous line written to the output file, and if the next line
 // is equal then it is skipped. This works because all the chunk files are sorted already, so it is
 // guaranteed that all duplicates will be seen together as it reads from the chunks.
-func mergeSortableScanners(outFile *os.File, progress *uint64, scanners []*sortableScanner) error {
-	// Create function to sort the scanners by their token, lexicographically by their bytes
-	sortScanners := func(i, j int) bool {
-		return scanners[i].token < scanners[j].token
-	}
+// It returns the number of lines written.
+func mergeSortableScanners(writer *bufio.Writer, progress *uint64, scanners []*sortableScanner) (uint64, error) {
+	// Create a min-heap of the scanners, ordered by their token
+	h := make(scannerHeap, len(scanners))
+	copy(h, scanners)
+	h.init()
 
-	// Create a buffered writer
-	writer := bufio.NewWriterSize(outFile, defaultBufferSize)
 	var (
-		previousLine string
+		previousLine []byte
 		hasPrevious  bool
 		ok           bool
 		err          error
 		lineCount    uint64
+		written      uint64
 	)
 
-	// Loop until there aren't any scanners left
-	for len(scanners) > 0 {
-		// Sort the scanners
-		if len(scanners) > 1 {
-			sort.Slice(scanners, sortScanners)
-		}
-
+	// Loop until there is only one scanner left
+	for len(h) > 1 {
 		// Pull the top token string, and compare to the previous line.
 		// If it matches the previous line, it is a duplicate we can skip.
-		if !hasPrevious || previousLine != scanners[0].token {
+		top := h[0]
+		if !hasPrevious || !bytes.Equal(previousLine, top.token) {
 			// Write to the output buffer
-			_, err = writer.WriteString(scanners[0].token)
+			_, err = writer.Write(top.token)
 			if err != nil {
-				return err
+				return written, err
 			}
 
 			// Write delimiter
 			err = writer.WriteByte(delimiter)
 			if err != nil {
-				return err
+				return written, err
 			}
-			previousLine = scanners[0].token
+			// Copy the line, because the token is only valid until the scanner advances
+			previousLine = append(previousLine[:0], top.token...)
 			hasPrevious = true
+			written++
 		}
 
 		// Regardless of whether it was written or ignored, advance the progress
@@ -410,38 +835,283 @@ func mergeSortableScanners(outFile *os.File, progress *uint64, scanners []*sorta
 		}
 
 		// Scan the next value
-		ok, err = scanners[0].next()
+		ok, err = top.next()
 		if err != nil {
-			return err
+			return written, err
 		}
-		if !ok {
-			// This scanner doesn't have any more lines, so remove from the slice
-			scanners = scanners[1:]
+		if ok {
+			// Move the scanner down to its new position in the heap
+			h.down(0)
+		} else {
+			// This scanner doesn't have any more lines, so release it and remove from the heap
+			top.close()
+			h.pop()
 		}
 	}
+
+	// The lines of the last scanner are already sorted and distinct, so only its first line can be a
+	// duplicate, and the rest are written without comparing them or touching the heap
+	if len(h) == 1 {
+		last := h[0]
+		if hasPrevious && bytes.Equal(previousLine, last.token) {
+			ok, err = last.next()
+			if err != nil {
+				return written, err
+			}
+			lineCount++
+		} else {
+			ok = true
+		}
+		for ok {
+			_, err = writer.Write(last.token)
+			if err != nil {
+				return written, err
+			}
+			err = writer.WriteByte(delimiter)
+			if err != nil {
+				return written, err
+			}
+			written++
+
+			lineCount++
+			if lineCount >= 1000 {
+				atomic.AddUint64(progress, lineCount)
+				lineCount = 0
+			}
+
+			ok, err = last.next()
+			if err != nil {
+				return written, err
+			}
+		}
+		last.close()
+	}
 	atomic.AddUint64(progress, lineCount)
+	return written, nil
+}
 
-	// Flush all remaining bytes to the file
-	return writer.Flush()
+// scannerHeap is a min-heap of sortableScanners, ordered by their token, lexicographically by their bytes.
+// It is implemented directly instead of with container/heap, so that every comparison is a plain
+// byte comparison rather than a call through heap.Interface.
+type scannerHeap []*sortableScanner
+
+// init establishes the heap ordering
+func (h scannerHeap) init() {
+	for i := len(h)/2 - 1; i >= 0; i-- {
+		h.down(i)
+	}
+}
+
+// down moves the scanner at index i down the heap, until its token is not greater than its children's
+func (h scannerHeap) down(i int) {
+	n := len(h)
+	ss := h[i]
+	for {
+		child := 2*i + 1
+		if child >= n {
+			break
+		}
+		if right := child + 1; right < n && bytes.Compare(h[right].token, h[child].token) < 0 {
+			child = right
+		}
+		if bytes.Compare(ss.token, h[child].token) <= 0 {
+			break
+		}
+		h[i] = h[child]
+		i = child
+	}
+	h[i] = ss
 }
 
-// sortableScanner is a struct containing the latest token string read in from the file,
-// as well as the file and scanner objects. It has methods to obtain the next token,
-// and the whole struct can easily be sorted in a slice based off the token.
+// pop removes the top scanner from the heap
+func (h *scannerHeap) pop() {
+	old := *h
+	n := len(old) - 1
+	old[0] = old[n]
+	old[n] = nil // Allow the scanner to be GC'ed
+	*h = old[:n]
+	if n > 0 {
+		h.down(0)
+	}
+}
+
+// sortableScanner is a struct containing the latest token read in from the file,
+// as well as the file and line reader objects. It has methods to obtain the next token,
+// and the whole struct can easily be ordered in a heap based off the token.
+// Where possible the file is memory mapped, so that tokens are read without copying the file.
+// Instead of a file, the scanner can also read the lines of a set that is still in memory.
 type sortableScanner struct {
-	token   string
-	scanner *bufio.Scanner
-	f       *os.File
+	token    []byte
+	lines    *lineReader
+	f        *os.File
+	mapped   []byte
+	released int // Bytes at the start of the mapping that have been released
+	set      *lineSet
+	order    []uint32 // Sorted positions of the set's lines that have not been read yet
+	last     []byte   // Last line of the chunk or set
+	count    uint64   // Number of lines in the chunk
+}
+
+// newSortableScanner creates a sortableScanner that reads the file from the beginning.
+// It memory maps the file, falling back to reading it in blocks if mapping is not possible.
+func newSortableScanner(f *os.File) (*sortableScanner, error) {
+	ss := &sortableScanner{f: f}
+
+	data, err := mmapFile(f)
+	if err == nil {
+		// The whole file is already in the buffer, so the line reader never has to read
+		ss.mapped = data
+		ss.lines = &lineReader{buf: data, end: len(data), err: io.EOF}
+		return ss, nil
+	}
+
+	// Seek to the beginning of the file to start reading again from the start
+	_, err = f.Seek(0, 0)
+	if err != nil {
+		return nil, err
+	}
+	ss.lines = newLineReader(f, defaultBufferSize) // Use a smaller buffer size since there are many chunks
+	return ss, nil
 }
 
-// next scans the next token string in the file, and sets it to the sortableScanner's token field.
+// newSetScanner creates a sortableScanner that reads the lines of the set in sorted order.
+// Any duplicates dropped from an unindexed set are added to the progress.
+func newSetScanner(set *lineSet, progress *uint64) *sortableScanner {
+	ss := &sortableScanner{
+		set:   set,
+		order: sortSet(set, progress),
+	}
+	if len(ss.order) > 0 {
+		ss.last = set.line(ss.order[len(ss.order)-1])
+	}
+	return ss
+}
+
+// next reads the next token in the file, and sets it to the sortableScanner's token field.
+// The token is only valid until the following call to next.
 // It returns true if this was successful, false if the end of the file was reached or an error.
 func (ss *sortableScanner) next() (bool, error) {
-	if ss.scanner.Scan() {
-		ss.token = ss.scanner.Text()
+	if ss.set != nil {
+		if len(ss.order) == 0 {
+			return false, nil
+		}
+		ss.token = ss.set.line(ss.order[0])
+		ss.order = ss.order[1:]
+		return true, nil
+	}
+
+	// Let the kernel drop the pages of a memory mapped file that have been merged already,
+	// so that they don't keep counting towards this program's memory usage
+	if ss.mapped != nil && ss.lines.start-ss.released >= releaseMappedBytes {
+		end := ss.lines.start - ss.lines.start%os.Getpagesize()
+		releaseMapped(ss.mapped[ss.released:end])
+		ss.released = end
+	}
+
+	var ok bool
+	ss.token, ok = ss.lines.next()
+	if ok {
 		return true, nil
 	}
 
 	// Return any error
-	return false, ss.scanner.Err()
+	return false, ss.lines.Err()
+}
+
+// close releases the memory mapping, if any, then closes and removes the temporary chunk file.
+// This is done as soon as a chunk has been fully merged, so that its disk space and the
+// kernel's cached pages for it are freed while the remaining chunks are still being merged.
+// A set is released so that it can be GC'ed.
+func (ss *sortableScanner) close() {
+	ss.set = nil
+	ss.order = nil
+	if ss.mapped != nil {
+		munmapFile(ss.mapped)
+		ss.mapped = nil
+	}
+	if ss.f != nil {
+		ss.f.Close()
+		os.Remove(ss.f.Name())
+		ss.f = nil
+	}
+}
+
+// lineReader reads new line delimited tokens from a reader in large blocks, and splits
+// each block into lines in place. Unlike bufio.Scanner, tokens are not limited in length,
+// and no memory is allocated per line: the returned tokens are slices of the block buffer.
+type lineReader struct {
+	r     io.Reader
+	buf   []byte
+	start int // Start of the unread bytes in buf
+	end   int // End of the valid bytes in buf
+	err   error
+}
+
+// newLineReader returns a lineReader that reads from r in blocks of size bytes
+func newLineReader(r io.Reader, size int) *lineReader {
+	return &lineReader{
+		r:   r,
+		buf: make([]byte, size),
+	}
+}
+
+// next returns the next token, without its delimiter or a trailing carriage return.
+// The token is only valid until the following call to next.
+// It returns false when the end of the file was reached or there was an error.
+func (lr *lineReader) next() ([]byte, bool) {
+	for {
+		// Split the next line out of the bytes already read
+		if i := bytes.IndexByte(lr.buf[lr.start:lr.end], delimiter); i >= 0 {
+			line := lr.buf[lr.start : lr.start+i]
+			lr.start += i + 1
+			return dropCR(line), true
+		}
+
+		if lr.err != nil {
+			// The final line might not end with a delimiter
+			if lr.err == io.EOF && lr.start < lr.end {
+				line := lr.buf[lr.start:lr.end]
+				lr.start = lr.end
+				return dropCR(line), true
+			}
+			return nil, false
+		}
+
+		lr.fill()
+	}
+}
+
+// fill moves any partial line to the beginning of the buffer, then reads the next block
+func (lr *lineReader) fill() {
+	if lr.start > 0 {
+		lr.end = copy(lr.buf, lr.buf[lr.start:lr.end])
+		lr.start = 0
+	}
+
+	// A single line fills the whole buffer, so grow it
+	if lr.end == len(lr.buf) {
+		buf := make([]byte, 2*len(lr.buf))
+		copy(buf, lr.buf[:lr.end])
+		lr.buf = buf
+	}
+
+	var n int
+	n, lr.err = lr.r.Read(lr.buf[lr.end:])
+	lr.end += n
+}
+
+// Err returns the first non-EOF error encountered while reading
+func (lr *lineReader) Err() error {
+	if lr.err == io.EOF {
+		return nil
+	}
+	return lr.err
+}
+
+// dropCR drops a terminal \r from the data, the same as bufio.ScanLines
+func dropCR(data []byte) []byte {
+	if len(data) > 0 && data[len(data)-1] == '\r' {
+		return data[:len(data)-1]
+	}
+	return data
 }
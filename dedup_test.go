@@ -2,8 +2,14 @@ package dedup
 
 import (
 	"bufio"
+	"fmt"
+	"math/rand"
 	"os"
 	"regexp"
+	"runtime"
+	"sort"
+	"strconv"
+	"strings"
 	"testing"
 )
 
@@ -155,3 +161,422 @@ func TestDedup3(t *testing.T) {
 	}
 	t.Logf("Line count matches (%d)", i)
 }
+
+func TestLineReader(t *testing.T) {
+	// Use a tiny block size, so that lines span blocks and the buffer has to grow
+	input := "abc\r\n\nlonger line than the buffer\nabc\nlast"
+	lines := newLineReader(strings.NewReader(input), 4)
+
+	var got []string
+	for line, ok := lines.next(); ok; line, ok = lines.next() {
+		got = append(got, string(line))
+	}
+	if err := lines.Err(); err != nil {
+		t.Fatal(err)
+	}
+
+	expected := []string{"abc", "", "longer line than the buffer", "abc", "last"}
+	if strings.Join(got, "|") != strings.Join(expected, "|") {
+		t.Fatalf("Lines (%q) should match (%q)", got, expected)
+	}
+}
+
+func TestDedupWithBloomFilter(t *testing.T) {
+	// testdata.log has 100 distinct lines, 204 total lines.
+	// Try with the possible duplicates fitting in memory, and with them spilling 20 lines at a time.
+	for _, tmpFileBytes := range []uint64{1000 * 50, 20 * 50} {
+		t.Run(strconv.FormatUint(tmpFileBytes, 10), func(t *testing.T) {
+			inFile, err := os.Open("testdata/testdata.log")
+			if err != nil {
+				t.Fatal(err)
+			}
+			defer inFile.Close()
+
+			outFile, err := os.CreateTemp("", "dedup.test.*.log")
+			if err != nil {
+				t.Fatal(err)
+			}
+			defer os.Remove(outFile.Name())
+			defer outFile.Close()
+
+			// A tiny filter, so that there are plenty of false positives
+			err = DedupWithBloomFilter(outFile, tmpFileBytes, 256, 2, nil, inFile, nil)
+			if err != nil {
+				t.Fatal(err)
+			}
+
+			// Seek to the beginning of the file to start reading from the beginning
+			_, err = outFile.Seek(0, 0)
+			if err != nil {
+				t.Fatal(err)
+			}
+			scanner := bufio.NewScanner(outFile)
+
+			// Read the data back in, confirm expectations
+			var i int
+			dedupSet := make(map[string]struct{})
+			for scanner.Scan() {
+				dedupSet[scanner.Text()] = struct{}{}
+				i++
+			}
+			if err = scanner.Err(); err != nil {
+				t.Fatal(err)
+			}
+
+			// The length of the hash set should match the length of the file
+			if i != 100 || i != len(dedupSet) {
+				t.Fatalf("Unique set length (%d) should be positive and match file line length (%d)", len(dedupSet), i)
+			}
+			t.Logf("Line count matches (%d)", i)
+		})
+	}
+}
+
+func TestLineSet(t *testing.T) {
+	set := newLineSet(0, true)
+
+	// Enough lines to grow the table several times, and a line larger than a slab
+	long := strings.Repeat("x", lineSlabSize+1)
+	var lines []string
+	for i := 0; i < 1000; i++ {
+		lines = append(lines, strconv.Itoa(i))
+	}
+	lines = append(lines, "", long)
+
+	var size int
+	for _, line := range lines {
+		if !set.add([]byte(line)) {
+			t.Fatalf("Line (%.10q) should be added", line)
+		}
+		size += len(line) + 1
+	}
+	for _, line := range lines {
+		if set.add([]byte(line)) {
+			t.Fatalf("Duplicate line (%.10q) should not be added", line)
+		}
+	}
+	if set.len() != len(lines) || set.bytes() != size {
+		t.Fatalf("Set length (%d) and bytes (%d) should match (%d) and (%d)", set.len(), set.bytes(), len(lines), size)
+	}
+	if set.find([]byte("missing")) != -1 {
+		t.Fatal("Missing line should not be found")
+	}
+
+	// The lines should come back sorted
+	sort.Strings(lines)
+	for i, pos := range set.sorted() {
+		if string(set.line(pos)) != lines[i] {
+			t.Fatalf("Sorted line (%.10q) should match (%.10q)", set.line(pos), lines[i])
+		}
+	}
+}
+
+func TestLineSetSorted(t *testing.T) {
+	// Sort in parallel, even on a single CPU
+	defer runtime.GOMAXPROCS(runtime.GOMAXPROCS(4))
+
+	// Lines sharing long prefixes, with zero bytes and lines that are prefixes of other lines
+	random := rand.New(rand.NewSource(1))
+	prefixes := []string{"", "https://www.example.com/", "https://www.example.com/path\x00"}
+	set := newLineSet(0, true)
+	var lines []string
+	for len(lines) < 2*minParallelSortLen {
+		line := make([]byte, random.Intn(20))
+		for i := range line {
+			line[i] = "ab\x00"[random.Intn(3)]
+		}
+		str := prefixes[random.Intn(len(prefixes))] + string(line)
+		if set.add([]byte(str)) {
+			lines = append(lines, str)
+		}
+	}
+
+	sort.Strings(lines)
+	for i, pos := range set.sorted() {
+		if string(set.line(pos)) != lines[i] {
+			t.Fatalf("Sorted line %d (%q) should match (%q)", i, set.line(pos), lines[i])
+		}
+	}
+}
+
+func TestLineSetUnindexed(t *testing.T) {
+	set := newLineSet(0, false)
+	lines := []string{"b", "a", "", "c", "a", "b", "", "b"}
+	for _, line := range lines {
+		if !set.add([]byte(line)) {
+			t.Fatalf("Line (%q) should always be added", line)
+		}
+	}
+	if set.find([]byte("a")) != -1 {
+		t.Fatal("Lines should not be found without an index")
+	}
+
+	// Duplicates should be dropped once sorted
+	var got []string
+	for _, pos := range set.sorted() {
+		got = append(got, string(set.line(pos)))
+	}
+	if strings.Join(got, "|") != "|a|b|c" {
+		t.Fatalf("Sorted lines (%q) should be distinct", got)
+	}
+}
+
+func TestDedupRepeatingTail(t *testing.T) {
+	// The first sets hardly catch any duplicates, so they stop being indexed,
+	// but the rest of the input repeats the same few lines, so indexing has to come back on
+	var input strings.Builder
+	var total uint64
+	for i := 0; i < 5000; i++ {
+		fmt.Fprintf(&input, "unique %04d\n", i)
+		total++
+	}
+	for i := 0; i < 100000; i++ {
+		fmt.Fprintf(&input, "repeat %02d\n", i%20)
+		total++
+	}
+
+	var progress uint64
+	chunks, sets, err := splitSortDeduplicate(100000, nil, nil, nil, &progress, strings.NewReader(input.String()))
+	defer func() {
+		for _, chunk := range chunks {
+			os.Remove(chunk.name)
+		}
+	}()
+	if err != nil {
+		t.Fatal(err)
+	}
+	if len(chunks) > 3 {
+		t.Fatalf("Chunk count (%d) should stay small once the input repeats", len(chunks))
+	}
+
+	outFile, err := os.CreateTemp("", "dedup.test.*.log")
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer os.Remove(outFile.Name())
+	defer outFile.Close()
+
+	err = mergeChunks(outFile, &progress, chunks, sets)
+	if err != nil {
+		t.Fatal(err)
+	}
+
+	// Every line is either written or ignored, including duplicates dropped from unindexed sets
+	if progress != total*2 {
+		t.Fatalf("Progress (%d) should reach twice the line count (%d)", progress, total*2)
+	}
+
+	_, err = outFile.Seek(0, 0)
+	if err != nil {
+		t.Fatal(err)
+	}
+	var i int
+	scanner := bufio.NewScanner(outFile)
+	for scanner.Scan() {
+		expected := fmt.Sprintf("repeat %02d", i)
+		if i >= 20 {
+			expected = fmt.Sprintf("unique %04d", i-20)
+		}
+		if scanner.Text() != expected {
+			t.Fatalf("Line (%s) should match expected (%s)", scanner.Text(), expected)
+		}
+		i++
+	}
+	if err = scanner.Err(); err != nil {
+		t.Fatal(err)
+	}
+	if i != 5020 {
+		t.Fatalf("File line length (%d) should match the unique line count (5020)", i)
+	}
+}
+
+func TestDedupRepeatingShortTail(t *testing.T) {
+	// With short lines, a set sized for every line of an unindexed set, duplicates included,
+	// would not fit into memory, and would spill again straight away
+	var input strings.Builder
+	for i := 0; i < 20000; i++ {
+		fmt.Fprintf(&input, "u%05d\n", i)
+	}
+	for i := 0; i < 100000; i++ {
+		fmt.Fprintf(&input, "r%d\n", i%5)
+	}
+
+	var progress uint64
+	chunks, sets, err := splitSortDeduplicate(100000, nil, nil, nil, &progress, strings.NewReader(input.String()))
+	defer func() {
+		for _, chunk := range chunks {
+			os.Remove(chunk.name)
+		}
+	}()
+	if err != nil {
+		t.Fatal(err)
+	}
+	if len(chunks) > 8 {
+		t.Fatalf("Chunk count (%d) should stay small once the input repeats", len(chunks))
+	}
+	if last := sets[len(sets)-1]; !last.indexed || last.len() != 5 {
+		t.Fatalf("Last set (%d lines, indexed %t) should hold the repeated lines indexed", last.len(), last.indexed)
+	}
+}
+
+func TestDedupManyChunks(t *testing.T) {
+	inFile, err := os.Open("testdata/testdata.log")
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer inFile.Close()
+
+	outFile, err := os.CreateTemp("", "dedup.test.*.log")
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer os.Remove(outFile.Name())
+	defer outFile.Close()
+
+	// testdata.log has 100 distinct lines, 204 total lines. Dedup just a couple of lines at a time,
+	// so that there are more chunks than can be merged at once
+	err = Dedup(outFile, 150, nil, inFile, nil)
+	if err != nil {
+		t.Fatal(err)
+	}
+
+	// Seek to the beginning of the file to start reading from the beginning
+	_, err = outFile.Seek(0, 0)
+	if err != nil {
+		t.Fatal(err)
+	}
+	scanner := bufio.NewScanner(outFile)
+
+	// Read the data back in, confirm expectations
+	var i int
+	var previous string
+	for scanner.Scan() {
+		if i > 0 && scanner.Text() <= previous {
+			t.Fatalf("Line (%s) should be sorted after the previous line (%s)", scanner.Text(), previous)
+		}
+		previous = scanner.Text()
+		i++
+	}
+	if err = scanner.Err(); err != nil {
+		t.Fatal(err)
+	}
+
+	if i != 100 {
+		t.Fatalf("File line length (%d) should match the unique line count (100)", i)
+	}
+	t.Logf("Line count matches (%d)", i)
+}
+
+func TestDedupSortedInput(t *testing.T) {
+	// Already sorted input makes chunks that do not overlap, so every chunk is copied instead of merged.
+	// A repeated line never starts a new chunk, so duplicates stay within the chunk of their first line.
+	var input strings.Builder
+	for i := 0; i < 1000; i++ {
+		line := fmt.Sprintf("line %04d\n", i)
+		input.WriteString(line)
+		if i%7 == 0 {
+			input.WriteString(line)
+		}
+	}
+
+	outFile, err := os.CreateTemp("", "dedup.test.*.log")
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer os.Remove(outFile.Name())
+	defer outFile.Close()
+
+	err = Dedup(outFile, 1000, nil, strings.NewReader(input.String()), nil)
+	if err != nil {
+		t.Fatal(err)
+	}
+
+	_, err = outFile.Seek(0, 0)
+	if err != nil {
+		t.Fatal(err)
+	}
+	var i int
+	scanner := bufio.NewScanner(outFile)
+	for scanner.Scan() {
+		if expected := fmt.Sprintf("line %04d", i); scanner.Text() != expected {
+			t.Fatalf("Line (%s) should match expected (%s)", scanner.Text(), expected)
+		}
+		i++
+	}
+	if err = scanner.Err(); err != nil {
+		t.Fatal(err)
+	}
+	if i != 1000 {
+		t.Fatalf("File line length (%d) should match the unique line count (1000)", i)
+	}
+}
+
+func TestMergeChunkGroupRuns(t *testing.T) {
+	// Chunks that touch or overlap each other, or a set, have to be merged,
+	// while the chunks in between are copied
+	contents := [][]string{
+		{"a", "b", "c"}, // Touches the next chunk at c
+		{"c", "d"},
+		{"e", "f"}, // Copied
+		{"g", "k"}, // Overlaps the next chunk and the set
+		{"h", "i"},
+		{"x", "y"}, // Copied
+	}
+	var chunks []*chunk
+	defer func() {
+		for _, chunk := range chunks {
+			os.Remove(chunk.name)
+		}
+	}()
+	for _, lines := range contents {
+		set := newLineSet(0, true)
+		for _, line := range lines {
+			set.add([]byte(line))
+		}
+		chunk, err := writeChunk(set, nil)
+		if err != nil {
+			t.Fatal(err)
+		}
+		chunks = append(chunks, chunk)
+	}
+
+	set := newLineSet(0, true)
+	for _, line := range []string{"j", "i"} {
+		set.add([]byte(line))
+	}
+
+	outFile, err := os.CreateTemp("", "dedup.test.*.log")
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer os.Remove(outFile.Name())
+	defer outFile.Close()
+
+	var progress uint64
+	written, err := mergeChunkGroup(outFile, &progress, chunks, []*lineSet{set})
+	if err != nil {
+		t.Fatal(err)
+	}
+	if written != 13 {
+		t.Fatalf("Written line count (%d) should match the unique line count (13)", written)
+	}
+
+	_, err = outFile.Seek(0, 0)
+	if err != nil {
+		t.Fatal(err)
+	}
+	var got []string
+	scanner := bufio.NewScanner(outFile)
+	for scanner.Scan() {
+		got = append(got, scanner.Text())
+	}
+	if err = scanner.Err(); err != nil {
+		t.Fatal(err)
+	}
+	if strings.Join(got, "|") != "a|b|c|d|e|f|g|h|i|j|k|x|y" {
+		t.Fatalf("Merged lines (%q) should be sorted and distinct", got)
+	}
+	if progress != 15 {
+		t.Fatalf("Progress (%d) should count every line read (15)", progress)
+	}
+}
@@ -0,0 +1,407 @@
+package dedup
+
+import (
+	"bytes"
+	"encoding/binary"
+	"hash/maphash"
+	"math"
+	"runtime"
+	"sync"
+)
+
+// lineSlabSize is the size of each slab of memory that lines are appended into
+const lineSlabSize int = 1024 * 1024 // 1 mb
+
+// lineSet is a set of distinct lines. Rather than each line being its own string allocation,
+// the lines are appended back to back (each followed by a delimiter) into large slabs of memory,
+// and located by their offset and length. The lines are indexed by an open addressing hash table
+// of their positions, so none of the per-line data holds any pointers for the garbage collector
+// to scan, growing the set never copies the lines, and each line only costs around 24 bytes
+// on top of the bytes that will be written out.
+// A set can also be created without the table, in which case every line is added to it without
+// being hashed or looked up, and duplicates are dropped once the lines are sorted instead.
+type lineSet struct {
+	slabs   [][]byte
+	locs    []uint64 // Slab number << 32 | offset into the slab, of each line
+	lengths []uint32 // Length of each line, including its delimiter
+	table   []uint64 // Upper 32 bits of the line's hash << 32 | position of the line + 1, or 0 if empty
+	indexed bool
+	size    int
+	hash    maphash.Hash
+}
+
+// lineSetSeed is shared by all sets
+var lineSetSeed = maphash.MakeSeed()
+
+// maxLineSetLen is the most lines a lineSet can hold, because positions are stored in 32 bits
+const maxLineSetLen int = math.MaxUint32 - 1
+
+// minLineSetTableSize is the smallest table a lineSet starts with
+const minLineSetTableSize int = 16
+
+// lineSetLineMemory is the memory used per line by a lineSet, not counting the line and table:
+// its location and length
+const lineSetLineMemory int = 8 + 4
+
+// newLineSet creates a lineSet with room for the given number of lines.
+// If indexed is false, the set does not deduplicate lines until they are sorted.
+func newLineSet(lines int, indexed bool) *lineSet {
+	ls := &lineSet{
+		locs:    make([]uint64, 0, lines),
+		lengths: make([]uint32, 0, lines),
+		indexed: indexed,
+	}
+	if indexed {
+		tableSize := minLineSetTableSize
+		for tableSize*3 <= lines*4 {
+			tableSize *= 2
+		}
+		ls.table = make([]uint64, tableSize)
+	}
+	ls.hash.SetSeed(lineSetSeed)
+	return ls
+}
+
+// len returns the number of lines in the set, which are all distinct if the set is indexed
+func (ls *lineSet) len() int {
+	return len(ls.locs)
+}
+
+// full returns true if no more lines can be added to the set
+func (ls *lineSet) full() bool {
+	return len(ls.locs) >= maxLineSetLen
+}
+
+// bytes returns the number of bytes the lines take up when written out, including delimiters
+func (ls *lineSet) bytes() int {
+	return ls.size
+}
+
+// memoryToAdd returns the bytes of memory the set will be using after adding a new line of the given
+// length: the bytes of every line and its delimiter, plus each line's location and length, plus the table.
+// This leaves out only the unused remainder of the last slab and any spare capacity.
+func (ls *lineSet) memoryToAdd(length int) int {
+	lines := len(ls.locs) + 1
+	table := len(ls.table)
+	if ls.indexed && lines*4 >= table*3 {
+		table *= 2 // Adding this line will grow the table
+	}
+	return ls.size + length + 1 + lines*lineSetLineMemory + table*8
+}
+
+// lineWithDelimiter returns the line at position i, including its delimiter
+func (ls *lineSet) lineWithDelimiter(i uint32) []byte {
+	loc := ls.locs[i]
+	offset := uint32(loc)
+	return ls.slabs[loc>>32][offset : offset+ls.lengths[i]]
+}
+
+// line returns the line at position i, without its delimiter
+func (ls *lineSet) line(i uint32) []byte {
+	line := ls.lineWithDelimiter(i)
+	return line[:len(line)-1]
+}
+
+// probe returns the slot in the table that holds the line, or the empty slot where it belongs
+func (ls *lineSet) probe(line []byte) (slot int, tag uint64) {
+	ls.hash.Reset()
+	ls.hash.Write(line)
+	tag = ls.hash.Sum64() >> 32
+
+	mask := len(ls.table) - 1
+	for slot = int(tag) & mask; ; slot = (slot + 1) & mask {
+		entry := ls.table[slot]
+		if entry == 0 || (entry>>32 == tag && bytes.Equal(ls.line(uint32(entry)-1), line)) {
+			return slot, tag
+		}
+	}
+}
+
+// find returns the position of the line in the set, or -1 if it is not in the set.
+// Lines can't be found in a set that is not indexed.
+func (ls *lineSet) find(line []byte) int {
+	if !ls.indexed {
+		return -1
+	}
+	slot, _ := ls.probe(line)
+	return int(uint32(ls.table[slot])) - 1
+}
+
+// add copies the line into the set, if it is not already in it.
+// It returns true if the line was added, false if it was a duplicate.
+// A set that is not indexed always adds the line.
+func (ls *lineSet) add(line []byte) bool {
+	var slot int
+	var tag uint64
+	if ls.indexed {
+		slot, tag = ls.probe(line)
+		if ls.table[slot] != 0 {
+			return false
+		}
+	}
+
+	// Append the line and its delimiter to the last slab, or start a new one if it doesn't fit
+	size := len(line) + 1
+	last := len(ls.slabs) - 1
+	if last < 0 || cap(ls.slabs[last])-len(ls.slabs[last]) < size {
+		slabSize := lineSlabSize
+		if size > slabSize {
+			slabSize = size
+		}
+		ls.slabs = append(ls.slabs, make([]byte, 0, slabSize))
+		last++
+	}
+	slab := ls.slabs[last]
+	ls.locs = append(ls.locs, uint64(last)<<32|uint64(len(slab)))
+	ls.lengths = append(ls.lengths, uint32(size))
+	slab = append(slab, line...)
+	ls.slabs[last] = append(slab, delimiter)
+	ls.size += size
+
+	if ls.indexed {
+		ls.table[slot] = tag<<32 | uint64(len(ls.locs))
+		if len(ls.locs)*4 >= len(ls.table)*3 {
+			ls.grow()
+		}
+	}
+	return true
+}
+
+// grow doubles the size of the table. The table holds enough of each hash to place the lines
+// again without rehashing them.
+func (ls *lineSet) grow() {
+	table := make([]uint64, 2*len(ls.table))
+	mask := len(table) - 1
+	for _, entry := range ls.table {
+		if entry == 0 {
+			continue
+		}
+		slot := int(entry>>32) & mask
+		for table[slot] != 0 {
+			slot = (slot + 1) & mask
+		}
+		table[slot] = entry
+	}
+	ls.table = table
+}
+
+// minParallelSortLen is the fewest lines that are worth sorting in parallel
+const minParallelSortLen int = 64 * 1024
+
+// sorted returns the positions of all distinct lines in the set, ordered by their line lexicographically.
+// Large sets are split into one run per CPU, which are sorted in parallel and then merged.
+func (ls *lineSet) sorted() []uint32 {
+	order := ls.sortedWithDuplicates()
+	if ls.indexed {
+		return order
+	}
+
+	// Duplicates are next to each other once sorted, so keep only the first of each
+	kept := 0
+	for i, pos := range order {
+		if i == 0 || !bytes.Equal(ls.line(pos), ls.line(order[kept-1])) {
+			order[kept] = pos
+			kept++
+		}
+	}
+	return order[:kept]
+}
+
+// sortedWithDuplicates returns the positions of all lines in the set, ordered by their line lexicographically
+func (ls *lineSet) sortedWithDuplicates() []uint32 {
+	n := ls.len()
+	order := make([]uint32, n)
+	for i := range order {
+		order[i] = uint32(i)
+	}
+
+	runs := runtime.GOMAXPROCS(0)
+	if runs < 2 || n < minParallelSortLen {
+		ls.sortPositions(order)
+		return order
+	}
+
+	// Sort each run in parallel
+	width := (n + runs - 1) / runs
+	var wg sync.WaitGroup
+	for lo := 0; lo < n; lo += width {
+		wg.Add(1)
+		go func(run []uint32) {
+			defer wg.Done()
+			ls.sortPositions(run)
+		}(order[lo:minInt(lo+width, n)])
+	}
+	wg.Wait()
+
+	// Merge pairs of neighboring runs in parallel, until there is only one run left
+	merged := make([]uint32, n)
+	for ; width < n; width *= 2 {
+		for lo := 0; lo < n; lo += 2 * width {
+			mid, hi := minInt(lo+width, n), minInt(lo+2*width, n)
+			wg.Add(1)
+			go func(a, b, dst []uint32) {
+				defer wg.Done()
+				ls.mergePositions(a, b, dst)
+			}(order[lo:mid], order[mid:hi], merged[lo:hi])
+		}
+		wg.Wait()
+		order, merged = merged, order
+	}
+	return order
+}
+
+// sortPositions sorts the positions by their line lexicographically.
+// Rather than comparing lines, which means following each position to its line on every comparison,
+// it copies 8 bytes of each line into a key next to the position, and radix sorts by the keys.
+// Lines that share a key and continue past it are then sorted by their next 8 bytes, and so on.
+func (ls *lineSet) sortPositions(order []uint32) {
+	entries := make([]sortEntry, len(order))
+	for i, pos := range order {
+		entries[i].pos = pos
+	}
+	ls.radixSort(entries, make([]sortEntry, len(entries)), 0)
+	for i := range entries {
+		order[i] = entries[i].pos
+	}
+}
+
+// sortEntry is the position of a line, with a key holding 8 bytes of the line from the depth being sorted,
+// and how many bytes of the line are left from that depth, capped at 9 for lines that continue past the key
+type sortEntry struct {
+	key  uint64
+	left uint32
+	pos  uint32
+}
+
+// minRadixSortLen is the fewest entries that are worth radix sorting, instead of using an insertion sort
+const minRadixSortLen int = 64
+
+// radixSort sorts the entries by the bytes of their lines from depth onwards, using buf as scratch space.
+// Every line must have more than depth bytes, except at a depth of zero.
+func (ls *lineSet) radixSort(entries, buf []sortEntry, depth int) {
+	for i := range entries {
+		entries[i].key, entries[i].left = lineKey(ls.line(entries[i].pos), depth)
+	}
+
+	if len(entries) < minRadixSortLen {
+		insertionSortEntries(entries)
+	} else {
+		// Least significant digit first: the bytes left, then each byte of the key from the last
+		src, dst := entries, buf
+		if radixPass(src, dst, 0, true) {
+			src, dst = dst, src
+		}
+		for shift := uint(0); shift < 64; shift += 8 {
+			if radixPass(src, dst, shift, false) {
+				src, dst = dst, src
+			}
+		}
+		if &src[0] != &entries[0] {
+			copy(entries, src)
+		}
+	}
+
+	// Lines that share a key and continue past it still have to be sorted by the rest of their bytes
+	for lo := 0; lo < len(entries); {
+		hi := lo + 1
+		for hi < len(entries) && entries[hi].key == entries[lo].key && entries[hi].left == entries[lo].left {
+			hi++
+		}
+		if hi-lo > 1 && entries[lo].left > 8 {
+			ls.radixSort(entries[lo:hi], buf[lo:hi], depth+8)
+		}
+		lo = hi
+	}
+}
+
+// lineKey returns the 8 bytes of the line from depth as a big endian number, padded with zeros,
+// and how many bytes of the line are left from depth, capped at 9
+func lineKey(line []byte, depth int) (uint64, uint32) {
+	rest := line[depth:]
+	if len(rest) > 8 {
+		return binary.BigEndian.Uint64(rest), 9
+	}
+	var key uint64
+	for i, c := range rest {
+		key |= uint64(c) << (56 - 8*uint(i))
+	}
+	return key, uint32(len(rest))
+}
+
+// radixPass does a stable counting sort of src into dst, by one byte of the key at shift,
+// or by the bytes left if left is true. It returns false without doing anything if all the
+// entries have the same byte, in which case they are already in order.
+func radixPass(src, dst []sortEntry, shift uint, left bool) bool {
+	var counts [256]int
+	if left {
+		for i := range src {
+			counts[byte(src[i].left)]++
+		}
+	} else {
+		for i := range src {
+			counts[byte(src[i].key>>shift)]++
+		}
+	}
+
+	// Turn the counts into offsets
+	offset := 0
+	for b, count := range counts {
+		if count == len(src) {
+			return false
+		}
+		counts[b] = offset
+		offset += count
+	}
+
+	if left {
+		for i := range src {
+			b := byte(src[i].left)
+			dst[counts[b]] = src[i]
+			counts[b]++
+		}
+	} else {
+		for i := range src {
+			b := byte(src[i].key >> shift)
+			dst[counts[b]] = src[i]
+			counts[b]++
+		}
+	}
+	return true
+}
+
+// insertionSortEntries sorts a small number of entries by their key, then the bytes left
+func insertionSortEntries(entries []sortEntry) {
+	for i := 1; i < len(entries); i++ {
+		e := entries[i]
+		j := i
+		for ; j > 0 && (entries[j-1].key > e.key || (entries[j-1].key == e.key && entries[j-1].left > e.left)); j-- {
+			entries[j] = entries[j-1]
+		}
+		entries[j] = e
+	}
+}
+
+// mergePositions merges two sorted slices of positions into dst, which must fit both
+func (ls *lineSet) mergePositions(a, b, dst []uint32) {
+	i, j, k := 0, 0, 0
+	for i < len(a) && j < len(b) {
+		if bytes.Compare(ls.line(b[j]), ls.line(a[i])) < 0 {
+			dst[k] = b[j]
+			j++
+		} else {
+			dst[k] = a[i]
+			i++
+		}
+		k++
+	}
+	k += copy(dst[k:], a[i:])
+	copy(dst[k:], b[j:])
+}
+
+// minInt returns the smaller of two ints
+func minInt(a, b int) int {
+	if a < b {
+		return a
+	}
+	return b
+}
@@ -0,0 +1,43 @@
+package dedup
+
+import (
+	"errors"
+	"os"
+	"syscall"
+)
+
+// mmapFile maps the whole file into memory as read-only,
+// and advises the kernel that it will be read sequentially
+func mmapFile(f *os.File) ([]byte, error) {
+	info, err := f.Stat()
+	if err != nil {
+		return nil, err
+	}
+	size := info.Size()
+	if size <= 0 || int64(int(size)) != size {
+		return nil, errors.New("unable to memory map file: " + f.Name())
+	}
+
+	data, err := syscall.Mmap(int(f.Fd()), 0, int(size), syscall.PROT_READ, syscall.MAP_SHARED)
+	if err != nil {
+		return nil, err
+	}
+
+	// Only a hint, so the error can be ignored
+	_ = syscall.Madvise(data, syscall.MADV_SEQUENTIAL)
+	return data, nil
+}
+
+// munmapFile releases memory mapped by mmapFile
+func munmapFile(data []byte) error {
+	return syscall.Munmap(data)
+}
+
+// releaseMapped tells the kernel that the memory mapped pages will not be needed again,
+// so they can be dropped. The data must start on a page boundary.
+func releaseMapped(data []byte) {
+	if len(data) > 0 {
+		// Only advice, so the error can be ignored
+		_ = syscall.Madvise(data, syscall.MADV_DONTNEED)
+	}
+}
@@ -0,0 +1,22 @@
+//go:build !linux
+// +build !linux
+
+package dedup
+
+import (
+	"errors"
+	"os"
+)
+
+// mmapFile is not supported on this platform, so files will be read in blocks instead
+func mmapFile(f *os.File) ([]byte, error) {
+	return nil, errors.New("memory mapping files is not supported on this platform")
+}
+
+// munmapFile is not supported on this platform
+func munmapFile(data []byte) error {
+	return nil
+}
+
+// releaseMapped is not supported on this platform
+func releaseMapped(data []byte) {}
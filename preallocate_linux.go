@@ -0,0 +1,18 @@
+package dedup
+
+import (
+	"os"
+	"syscall"
+)
+
+// fallocKeepSize is FALLOC_FL_KEEP_SIZE, which allocates the disk blocks without changing the file size
+const fallocKeepSize uint32 = 0x1
+
+// preallocateFile asks the filesystem to allocate size bytes for the file up front,
+// so that it can be laid out in large contiguous extents instead of growing with every write
+func preallocateFile(f *os.File, size int64) error {
+	if size <= 0 {
+		return nil
+	}
+	return syscall.Fallocate(int(f.Fd()), fallocKeepSize, 0, size)
+}
@@ -0,0 +1,13 @@
+//go:build !linux
+// +build !linux
+
+package dedup
+
+import (
+	"os"
+)
+
+// preallocateFile is not supported on this platform, so files grow with every write instead
+func preallocateFile(f *os.File, size int64) error {
+	return nil
+}